@@ -13,12 +13,69 @@ import pprint
 import inspect
 import re
 import types
+import json
+import time
+import signal
+import sqlite3
+import glob
+import shutil
+import multiprocessing
+import hashlib
 import pyral
 import datetime
+import calendar
 
 __version__ = '0.0.0'
 
 
+def touches(*entities):
+    """Record the rally entity types a check function reads."""
+    def decorator(check_func):
+        """Attach entities to check_func."""
+        check_func.entities = entities
+        return check_func
+    return decorator
+
+
+def volatile(check_func):
+    """Mark a check whose findings can change while its entities don't."""
+    check_func.volatile = True
+    return check_func
+
+
+def fixes(check_func):
+    """Register the decorated function as the fixer of check_func."""
+    def decorator(fix_func):
+        """Attach fix_func to check_func."""
+        check_func.fixer = fix_func
+        return fix_func
+    return decorator
+
+
+def server_query(entity_name):
+    """
+    Turn a function returning a RallyQuery into a check function.
+
+    The check reports every entity_name matching the query, so in summary
+    mode rally can count its findings without sending them.
+    """
+    def decorator(query_func):
+        """Build the check function for query_func."""
+        def check(rally):
+            """Format the entities matching the query."""
+            return [format_artifact(a)
+                    for a in rally.get(entity_name, query_func(rally))]
+
+        check.__name__ = query_func.__name__
+        check.__doc__ = query_func.__doc__
+        check.entities = (entity_name,)
+        check.entity_name = entity_name
+        check.query = query_func
+        return check
+    return decorator
+
+
+@touches('Task', 'HierarchicalRequirement')
 def check_tasks_with_no_owner(rally):
     """Disowned tasks."""
     # Some filters like include_feature can only be applied to stories
@@ -27,12 +84,25 @@ def check_tasks_with_no_owner(rally):
     # separately and do a manual filteing of tasks
     # This logic should ideally be factored out of check function
     tasks = rally.get('Task', RallyQuery("Owner = null"))
-    story_ids = [s.ObjectID for s in rally.get('HierarchicalRequirement')]
+    stories = rally.index('HierarchicalRequirement')
 
     return [format_artifact(t) for t in tasks
-            if t.WorkProduct.ObjectID in story_ids]
+            if t.WorkProduct.ObjectID in stories]
 
 
+@fixes(check_tasks_with_no_owner)
+def fix_tasks_with_no_owner(rally):
+    """Give disowned tasks to the owner of their story."""
+    tasks = rally.get('Task', RallyQuery("Owner = null"))
+    stories = rally.index('HierarchicalRequirement')
+
+    return [Fix('Task', t, 'Owner', stories.get(t.WorkProduct.ObjectID).Owner)
+            for t in tasks
+            if t.WorkProduct.ObjectID in stories and
+            stories.get(t.WorkProduct.ObjectID).Owner is not None]
+
+
+@touches('Task', 'HierarchicalRequirement')
 def check_tasks_with_no_estimate(rally):
     """Unestimated tasks."""
     query = RallyQuery(
@@ -41,23 +111,25 @@ def check_tasks_with_no_estimate(rally):
         bool_op='OR')
 
     tasks = rally.get('Task', query=query)
-    story_ids = [s.ObjectID for s in rally.get('HierarchicalRequirement')]
+    stories = rally.index('HierarchicalRequirement')
 
     return [format_artifact(t) for t in tasks
-            if t.WorkProduct.ObjectID in story_ids]
+            if t.WorkProduct.ObjectID in stories]
 
 
+@touches('UserIterationCapacity')
 def check_users_with_no_capacity(rally):
     """Check for users with no capacity."""
     if 'filter_owner' not in rally.options:
         return []
 
-    uics = rally.get('UserIterationCapacity',
-                     RallyQuery('User != null'))
-    uwc = [uic.User.UserName for uic in uics]
-    return [u for u in rally.options['filter_owner'] if u not in uwc]
+    uics = rally.index('UserIterationCapacity',
+                       RallyQuery('User != null'))
+    return [u for u in rally.options['filter_owner']
+            if not uics.lookup('owner', u)]
 
 
+@touches('HierarchicalRequirement')
 def check_users_with_no_stories(rally):
     """Available users."""
     if 'filter_owner' not in rally.options:
@@ -71,6 +143,7 @@ def check_users_with_no_stories(rally):
     return [u for u in users - users_with_stories]
 
 
+@touches('HierarchicalRequirement')
 def check_users_with_hi_points(rally):
     """Overstoried users."""
     if 'filter_owner' not in rally.options:
@@ -95,6 +168,7 @@ def check_users_with_hi_points(rally):
             if info[ikey] > float(rally.options['points_per_iteration'])]
 
 
+@touches('HierarchicalRequirement')
 def check_users_with_lo_points(rally):
     """Understoried users."""
     if 'filter_owner' not in rally.options:
@@ -120,6 +194,7 @@ def check_users_with_lo_points(rally):
                    float(rally.options['points_per_iteration'])])
 
 
+@touches('HierarchicalRequirement')
 def check_epics_with_too_many_cooks(rally):
     """Too many cooks."""
     epics = {}
@@ -147,16 +222,16 @@ def check_epics_with_too_many_cooks(rally):
     return tmc
 
 
+@server_query('HierarchicalRequirement')
 def check_stories_with_hi_points(rally):
     """Oversized stories."""
-    query = RallyQuery([
+    return RallyQuery([
         'PlanEstimate > {0}'.format(rally.options['points_per_iteration']),
         'DirectChildrenCount = 0'])
 
-    return [format_artifact(t)
-            for t in rally.get('HierarchicalRequirement', query)]
-
 
+# TaskEstimates is rolled up from Tasks, so their updates count too
+@touches('UserIterationCapacity', 'Task')
 def check_users_with_too_many_tasks(rally):
     """Overtasked users."""
     # get user's capacity
@@ -171,12 +246,14 @@ def check_users_with_too_many_tasks(rally):
             for uic in uic_list]
 
 
+@volatile
+@touches('HierarchicalRequirement')
 def check_stories_with_incomp_pred(rally):
     """Incomplete dependencies."""
-    current_stories = rally.get('HierarchicalRequirement')
-
-    unmet_deps = {}
-    for story in current_stories:
+    # This walk is slow (every predecessor is fetched lazily), so findings
+    # are yielded as they are found and survive a check timeout.
+    for story in rally.get('HierarchicalRequirement'):
+        unmet_deps = []
         for pred in story.Predecessors:
             if pred.ScheduleState != 'Completed':
                 siter = story.Iteration
@@ -184,34 +261,30 @@ def check_stories_with_incomp_pred(rally):
                 if (piter is None or siter.StartDate < piter.StartDate or
                    (siter.StartDate == piter.StartDate and
                     story.Owner.UserName != pred.Owner.UserName)):
-                    unmet_deps[story] = unmet_deps.get(story, []) + [pred]
+                    unmet_deps.append(pred)
 
-    return [
-        '{0} has unmet dependencies:\n    {1}'.format(
-            format_artifact(s),
-            '\n    '.join([format_artifact(d) for d in unmet_deps[s]]))
-        for s in unmet_deps.keys()]
+        if unmet_deps:
+            yield '{0} has unmet dependencies:\n    {1}'.format(
+                format_artifact(story),
+                '\n    '.join([format_artifact(d) for d in unmet_deps]))
 
 
+@server_query('HierarchicalRequirement')
 def check_stories_with_no_points(rally):
     """Unestimated stories."""
-    query = RallyQuery(
+    return RallyQuery(
         ['PlanEstimate = null',
          'PlanEstimate = 0'],
         bool_op="OR")
 
-    return [format_artifact(s)
-            for s in rally.get('HierarchicalRequirement', query=query)]
-
 
+@server_query('HierarchicalRequirement')
 def check_stories_with_no_owner(rally):
     """Disowned stories."""
-    query = RallyQuery("Owner = null")
-
-    return [format_artifact(s)
-            for s in rally.get('HierarchicalRequirement', query=query)]
+    return RallyQuery("Owner = null")
 
 
+@touches('HierarchicalRequirement')
 def check_stories_with_no_desc(rally):
     """Undescribed stories."""
     return [format_artifact(s)
@@ -219,22 +292,19 @@ def check_stories_with_no_desc(rally):
             if len(s.Description) < 140]
 
 
+@server_query('HierarchicalRequirement')
 def check_stories_with_no_tasks(rally):
     """Untasked stories."""
-    query = RallyQuery("TaskStatus = NONE")
-
-    return [format_artifact(s)
-            for s in rally.get('HierarchicalRequirement', query=query)]
+    return RallyQuery("TaskStatus = NONE")
 
 
+@server_query('HierarchicalRequirement')
 def check_stories_blocked(rally):
     """Blocked stories."""
-    query = RallyQuery("Blocked = true")
-
-    return [format_artifact(s)
-            for s in rally.get('HierarchicalRequirement', query=query)]
+    return RallyQuery("Blocked = true")
 
 
+@touches('HierarchicalRequirement')
 def check_stories_with_lo_tasks(rally):
     """Undertasked stories."""
     def close_enough(points, task_hours):
@@ -252,6 +322,7 @@ def check_stories_with_lo_tasks(rally):
             if not close_enough(s.PlanEstimate, s.TaskEstimateTotal)]
 
 
+@touches('Task')
 def check_tasks_with_hi_hours(rally):
     """Oversized tasks."""
     return [format_artifact(t)
@@ -259,29 +330,102 @@ def check_tasks_with_hi_hours(rally):
             if float(t.Estimate) > 16]
 
 
+@server_query('HierarchicalRequirement')
 def check_stories_with_no_release(rally):
     """Release-less stories."""
-    return [format_artifact(s) for s in rally.get(
-        'HierarchicalRequirement',
-        RallyQuery('Release = null'))]
+    return RallyQuery('Release = null')
+
+
+@fixes(check_stories_with_no_release)
+def fix_stories_with_no_release(rally):
+    """Schedule stories in the release that contains their iteration."""
+    releases = rally.get('Release')
 
+    found = []
+    for story in rally.get('HierarchicalRequirement',
+                           check_stories_with_no_release.query(rally)):
+        itr = story.Iteration
+        if itr is None:
+            continue
 
+        matches = [r for r in releases
+                   if r.Project.ObjectID == story.Project.ObjectID and
+                   r.ReleaseStartDate <= itr.StartDate and
+                   r.ReleaseDate >= itr.EndDate]
+        if len(matches) == 1:
+            found.append(
+                Fix('HierarchicalRequirement', story, 'Release', matches[0]))
+
+    return found
+
+
+@server_query('HierarchicalRequirement')
 def check_stories_with_no_ac(rally):
     """Unacceptable stories."""
-    return [format_artifact(s) for s in rally.get(
-        'HierarchicalRequirement',
-        RallyQuery('Description !contains cceptance'))]
+    return RallyQuery('Description !contains cceptance')
 
 
+@volatile
+@server_query('Task')
 def check_tasks_with_no_update(rally):
     """Outdated tasks."""
-    three_days_ago = (datetime.datetime.utcnow() -
+    three_days_ago = (rally.started -
                       datetime.timedelta(days=3)).isoformat()
 
     date_term = 'LastUpdateDate < {0}'.format(three_days_ago)
 
-    return [format_artifact(t) for t in rally.get(
-        'Task', RallyQuery(['State = In-Progress', date_term]))]
+    return RallyQuery(['State = In-Progress', date_term])
+
+
+class Fix(object):
+
+    """An update of one artifact attribute that fixes a finding."""
+
+    def __init__(self, entity_name, artifact, attr, value):
+        """Fix constructor."""
+        super(Fix, self).__init__()
+        self.entity_name = entity_name
+        self.artifact = artifact
+        self.attr = attr
+        self.value = value
+        self.old_value = getattr(artifact, attr, None)
+
+    @staticmethod
+    def __ref(entity):
+        """Return the WSAPI reference of entity, or None."""
+        return None if entity is None else '/' + entity.ref
+
+    @staticmethod
+    def __describe(entity):
+        """Return a readable name for entity."""
+        if entity is None:
+            return '(none)'
+        return getattr(entity, 'UserName', None) or entity.Name
+
+    def diff(self):
+        """Describe the fix like US12345: Story name: Release a -> b."""
+        return '{0}: {1} {2} -> {3}'.format(
+            format_artifact(self.artifact),
+            self.attr,
+            self.__describe(self.old_value),
+            self.__describe(self.value))
+
+    def batch_entry(self):
+        """Return the WSAPI batch entry that applies the fix."""
+        return {'Entry': {
+            'Path': self.__ref(self.artifact),
+            'Method': 'post',
+            'Body': {self.entity_name.lower(): {
+                self.attr: self.__ref(self.value)}}}}
+
+    def log_entry(self):
+        """Return what is needed to undo the fix."""
+        return {'entity': self.entity_name,
+                'ref': self.__ref(self.artifact),
+                'artifact': self.artifact.FormattedID,
+                'attr': self.attr,
+                'old': self.__ref(self.old_value),
+                'new': self.__ref(self.value)}
 
 
 class RallyQuery(object):
@@ -300,7 +444,8 @@ class RallyQuery(object):
     def __validate_term(term):
         """Raise an exception if term is invalid."""
         if not (isinstance(term, RallyQuery) or
-                re.compile(r'^[^\s\(\)]+ [^\s\(\)]+ [^\s\(\)]+$').match(term)):
+                re.compile(r'^[^\s\(\)]+ [^\s\(\)]+ ("[^"]*"|[^\s\(\)]+)$')
+                .match(term)):
             raise ValueError('Invalid format. Must be a RallyQuery or a '
                              'string like: X > Y\n{0}'.format(term))
 
@@ -355,6 +500,106 @@ def build_attribute_reference(entity_name, attr):
     return attr_ref
 
 
+def resolve_attribute_reference(entity, attr_ref):
+    """Follow a dotted attribute reference, returning None at a dead end."""
+    for attr in attr_ref.split('.'):
+        if entity is None:
+            return None
+        entity = getattr(entity, attr, None)
+    return entity
+
+
+class EntityIndex(object):
+
+    """Index of fetched entities by ObjectID and common references."""
+
+    def __init__(self, entity_name, entities):
+        """EntityIndex constructor."""
+        super(EntityIndex, self).__init__()
+        self.entity_name = entity_name
+        self.entities = entities
+        self.__by_key = {}
+
+    def __iter__(self):
+        """Iterate over the indexed entities."""
+        return iter(self.entities)
+
+    def __len__(self):
+        """Return the number of indexed entities."""
+        return len(self.entities)
+
+    def __contains__(self, object_id):
+        """Is there an entity with object_id."""
+        return object_id in self.__index('oid')
+
+    def __attr_ref(self, key):
+        """Return the attribute reference for an index key."""
+        if key == 'owner':
+            return build_attribute_reference(self.entity_name, 'owner')
+        return {
+            'oid':          'ObjectID',
+            'iteration':    'Iteration.ObjectID',
+            'parent':       'Parent.ObjectID',
+            'work_product': 'WorkProduct.ObjectID'
+        }.get(key)
+
+    def __index(self, key):
+        """Build (once) and return the index for key."""
+        if key not in self.__by_key:
+            attr_ref = self.__attr_ref(key)
+            if attr_ref is None:
+                raise ValueError('{0} can not be indexed by {1}'.format(
+                    self.entity_name, key))
+
+            index = {}
+            for entity in self.entities:
+                value = resolve_attribute_reference(entity, attr_ref)
+                if value is not None:
+                    index.setdefault(value, []).append(entity)
+            self.__by_key[key] = index
+
+        return self.__by_key[key]
+
+    def get(self, object_id):
+        """Return the entity with object_id or None."""
+        entities = self.__index('oid').get(object_id)
+        return entities[0] if entities else None
+
+    def lookup(self, key, value):
+        """
+        Return the entities whose key matches value.
+
+        key is one of oid, owner (a UserName), iteration, parent or
+        work_product (ObjectIDs).
+        """
+        return self.__index(key).get(value, [])
+
+
+def parse_date_range(value):
+    """
+    Parse a date range like 2016-01-01..2016-06-30.
+
+    Returns a (start, end) tuple of date strings, or None if value isn't a
+    date range. Raises ValueError if either date is invalid.
+    """
+    if '..' not in value:
+        return None
+
+    dates = value.split('..')
+    if len(dates) != 2:
+        raise ValueError('Invalid date range: ' + value)
+
+    for date in dates:
+        datetime.datetime.strptime(date, '%Y-%m-%d')
+
+    return tuple(dates)
+
+
+def is_batch_iteration_filter(iters):
+    """Does iters select iterations by name or date range."""
+    return bool(iters) and iters not in [['current'], ['future']]
+
+
 class RalintFilter(object):
 
     """Ralint Filter."""
@@ -380,9 +625,9 @@ class RalintFilter(object):
 
             path = build_attribute_reference(entity_name, attr)
 
-            # if entity has no user attribute, return unmodified query
+            # if entity has no such attribute, skip this filter
             if path is None:
-                return query
+                continue
 
             filter_query = apply_func[attr](path, options['filter_' + attr])
 
@@ -405,16 +650,32 @@ class RalintFilter(object):
 
     def __apply_iter_filter(self, path, iters):
         """Apply iteration filter."""
+        prefix = path + '.' if path else ''
         if iters == ['current']:
             return RallyQuery([
-                path + '.StartDate' + ' <= today',
-                path + '.EndDate' + ' >= today'
+                prefix + 'StartDate' + ' <= today',
+                prefix + 'EndDate' + ' >= today'
             ])
         elif iters == ['future']:
             return RallyQuery(
-                path + '.EndDate' + ' >= today')
-        else:
-            raise ValueError('unknown filter_iteration value: ' + str(iters))
+                prefix + 'EndDate' + ' >= today')
+
+        # otherwise iters is a list of iteration names and date ranges
+        terms = []
+        for itr in iters:
+            if itr in ['current', 'future']:
+                raise ValueError('filter_iteration value {0} can not be '
+                                 'combined with others'.format(itr))
+
+            date_range = parse_date_range(itr)
+            if date_range is not None:
+                terms.append(RallyQuery([
+                    '{0}StartDate <= {1}'.format(prefix, date_range[1]),
+                    '{0}EndDate >= {1}'.format(prefix, date_range[0])]))
+            else:
+                terms.append('{0}Name = "{1}"'.format(prefix, itr))
+
+        return RallyQuery(terms, bool_op='OR')
 
     def __apply_feat_filter(self, path, features):
         """Apply feature filter."""
@@ -428,11 +689,17 @@ class Ralint(object):
 
     """Ralint main object."""
 
-    def __init__(self, pyral_rally_instance, conf_args):
+    def __init__(self, pyral_rally_instance, conf_args, tracer=None):
         """Ralint constructor."""
         super(Ralint, self).__init__()
         self.__rally = pyral_rally_instance
+        self.__indexes = {}
+        self.__versions = {}
         self.options = conf_args
+        self.tracer = tracer
+        self.deadline = None
+        # one clock for the whole run, so date queries match across views
+        self.started = datetime.datetime.utcnow()
 
     def get(self, entity_name, query=None):
         """
@@ -448,9 +715,128 @@ class Ralint(object):
 
         log().info('GET entity=%s query=%s', entity_name, str(query))
 
+        return list(self.__get(entity_name, query))
+
+    def count(self, entity_name, query=None):
+        """Return how many entities match query without fetching them."""
+        query = RalintFilter().apply(entity_name, query, self.options)
+
+        log().info('COUNT entity=%s query=%s', entity_name, str(query))
+
+        return self.__get(entity_name, query,
+                          fetch='ObjectID', pagesize=1, limit=1).resultCount
+
+    def versions(self, entity_name):
+        """Return the sorted (ObjectID, LastUpdateDate) of entity_name."""
+        return sorted((e.ObjectID, e.LastUpdateDate)
+                      for e in self.version_index(entity_name))
+
+    def version_index(self, entity_name):
+        """
+        Return an EntityIndex of entity_name fetching only what versions need.
+
+        Each entity carries ObjectID and LastUpdateDate, plus its Iteration
+        reference when it has one, so the download can be partitioned.
+        """
+        if entity_name not in self.__versions:
+            query = RalintFilter().apply(entity_name, None, self.options)
+            fetch = 'ObjectID,LastUpdateDate'
+            if build_attribute_reference(entity_name, 'iteration'):
+                fetch += ',Iteration'
+
+            log().info('VERSIONS entity=%s query=%s', entity_name, str(query))
+
+            self.__versions[entity_name] = EntityIndex(
+                entity_name, list(self.__get(entity_name, query,
+                                             fetch=fetch)))
+        return self.__versions[entity_name]
+
+    def update(self, fix_list, log_path=None, chunk_size=25):
+        """
+        Apply fixes through the WSAPI batch endpoint, chunk_size at a time.
+
+        Before each chunk is sent, its old values are appended to the
+        rollback log at log_path as JSON lines.
+        """
+        log_path = log_path or os.path.expanduser('~/.ralint.fixes')
+        url = '{0}/batch'.format(self.__rally.service_url)
+        token = self.__rally.obtainSecurityToken()
+        if token:
+            url += '?key=' + token
+
+        for start in range(0, len(fix_list), chunk_size):
+            chunk = fix_list[start:start + chunk_size]
+
+            with open(log_path, 'a') as log_file:
+                for fix in chunk:
+                    entry = fix.log_entry()
+                    entry['time'] = time.time()
+                    log_file.write(json.dumps(entry) + '\n')
+
+            log().info('BATCH %s updates', len(chunk))
+            response = self.__rally.session.post(
+                url, data=json.dumps({
+                    'Batch': [fix.batch_entry() for fix in chunk]}))
+
+            if response.status_code != 200:
+                errs = 'Batch update failed with HTTP status {0}'.format(
+                    response.status_code)
+                log().error(errs)
+                raise RuntimeError(errs)
+
+            # errors for one entry are reported in the result of that entry
+            batch_result = response.json().get('BatchResult', {})
+            errs = list(batch_result.get('Errors', []))
+            for fix, result in zip(chunk, batch_result.get('Results', [])):
+                errs.extend('{0}: {1}'.format(fix.artifact.FormattedID, err)
+                            for err in result.get('Errors', []))
+
+            if len(errs) > 0:
+                errs = '\n'.join(errs)
+                log().error('Could not apply fixes\n%s', errs)
+                raise RuntimeError(errs)
+
+    def project_name(self):
+        """Return the name of the project being checked."""
+        return (self.options.get('rally_project') or
+                self.__rally.getProject().Name)
+
+    def remaining(self):
+        """
+        Return the seconds left before the deadline, or None if unlimited.
+
+        Raises CheckTimeout once the deadline has passed.
+        """
+        if self.deadline is None:
+            return None
+
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise CheckTimeout()
+        return remaining
+
+    def bound_requests(self, session):
+        """Cap the timeout of requests sent through session at remaining()."""
+        request = session.request
+
+        def bounded_request(method, url, *args, **kwargs):
+            """Send a request that can't outlive the deadline."""
+            remaining = self.remaining()
+            if remaining is not None:
+                kwargs['timeout'] = min(kwargs.get('timeout') or remaining,
+                                        remaining)
+            return request(method, url, *args, **kwargs)
+
+        session.request = bounded_request
+
+    def __get(self, entity_name, query, **kwargs):
+        """Call pyral.Rally.get and raise if it reports errors."""
+        self.remaining()
+
         pyral_resp = self.__rally.get(entity_name,
                                       query=str(query),
-                                      projectScopeDown=True)
+                                      projectScopeDown=True,
+                                      **kwargs)
 
         if len(pyral_resp.errors) > 0:
             errs = '\n'.join(pyral_resp.errors)
@@ -460,12 +846,321 @@ class Ralint(object):
                         errs)
             raise RuntimeError(errs)
 
-        return list(pyral_resp)
+        return pyral_resp
+
+    def index(self, entity_name, query=None):
+        """
+        Return an EntityIndex of the entities matching query.
+
+        Entities are fetched once per run and shared by every check asking
+        for the same entity and query.
+        """
+        key = (entity_name, str(query))
+        if key not in self.__indexes:
+            self.__indexes[key] = EntityIndex(entity_name,
+                                              self.get(entity_name, query))
+        return self.__indexes[key]
+
+
+class IterationView(object):
+
+    """
+    A Ralint limited to one iteration of a multi iteration run.
+
+    Entities are fetched once for all the selected iterations and
+    partitioned locally, so each iteration costs no extra requests.
+    """
+
+    def __init__(self, ralint_obj, name, iteration_ids):
+        """IterationView constructor."""
+        super(IterationView, self).__init__()
+        self.__ralint = ralint_obj
+        self.__indexes = {}
+        self.name = name
+        self.iteration_ids = iteration_ids
+        self.options = ralint_obj.options
+        self.started = ralint_obj.started
+
+    @property
+    def deadline(self):
+        """Return the deadline of the underlying Ralint."""
+        return self.__ralint.deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        """Set the deadline of the underlying Ralint."""
+        self.__ralint.deadline = deadline
 
+    def get(self, entity_name, query=None):
+        """Get the entities scheduled for this iteration."""
+        entities = self.__ralint.index(entity_name, query)
+        if not build_attribute_reference(entity_name, 'iteration'):
+            return list(entities)
+
+        return [entity
+                for oid in self.iteration_ids
+                for entity in entities.lookup('iteration', oid)]
+
+    def versions(self, entity_name):
+        """Return the sorted (ObjectID, LastUpdateDate) of entity_name."""
+        entities = self.__ralint.version_index(entity_name)
+        if build_attribute_reference(entity_name, 'iteration'):
+            entities = [entity
+                        for oid in self.iteration_ids
+                        for entity in entities.lookup('iteration', oid)]
+        return sorted((e.ObjectID, e.LastUpdateDate) for e in entities)
+
+    def count(self, entity_name, query=None):
+        """Count this iteration's entities in the shared download."""
+        return len(self.get(entity_name, query))
+
+    def index(self, entity_name, query=None):
+        """Return an EntityIndex of this iteration's entities."""
+        key = (entity_name, str(query))
+        if key not in self.__indexes:
+            self.__indexes[key] = EntityIndex(entity_name,
+                                              self.get(entity_name, query))
+        return self.__indexes[key]
+
+
+def get_iteration_views(rally):
+    """
+    Return a list of (name, rally) pairs, one per selected iteration.
+
+    Rally projects each have their own iteration entities, so iterations
+    are grouped by name. When filter_iteration is current or future, the
+    run is not split and the only pair is (None, rally).
+    """
+    if not is_batch_iteration_filter(rally.options.get('filter_iteration')):
+        return [(None, rally)]
+
+    names = []
+    iteration_ids = {}
+    for itr in sorted(rally.get('Iteration'), key=lambda i: i.StartDate):
+        if itr.Name not in iteration_ids:
+            names.append(itr.Name)
+        iteration_ids.setdefault(itr.Name, []).append(itr.ObjectID)
+
+    return [(name, IterationView(rally, name, iteration_ids[name]))
+            for name in names]
+
+
+class RequestTracer(object):
+
+    """
+    Attribute pyral HTTP requests to the code that caused them.
+
+    Requests made while a check runs are attributed to the line of the
+    check function that was executing, which is where lazy references like
+    story.Owner.UserName are resolved. Other requests are attributed to
+    the innermost ralint function.
+    """
+
+    # ralint functions that only pass requests on
+    PLUMBING = frozenset(['source', 'record', 'traced_request',
+                          'bounded_request'])
 
-def output(title, details):
+    def __init__(self):
+        """RequestTracer constructor."""
+        super(RequestTracer, self).__init__()
+        self.check_func = None
+        self.__stats = {}
+
+    def install(self, session):
+        """Trace every request sent through a requests session."""
+        request = session.request
+
+        def traced_request(method, url, *args, **kwargs):
+            """Time a request and record where it came from."""
+            start = time.time()
+            try:
+                return request(method, url, *args, **kwargs)
+            finally:
+                self.record(method, url, time.time() - start)
+
+        session.request = traced_request
+
+    def source(self):
+        """Return (function name, line number) of the requesting code."""
+        check_code = getattr(self.check_func, '__code__', None)
+        ralint_file = _ralint_init.__code__.co_filename
+        ralint_frame = None
+
+        frame = sys._getframe(1)
+        while frame is not None:
+            if frame.f_code is check_code:
+                return self.check_func.__name__, frame.f_lineno
+            if (ralint_frame is None and
+                    frame.f_code.co_filename == ralint_file and
+                    frame.f_code.co_name not in self.PLUMBING):
+                ralint_frame = frame
+            frame = frame.f_back
+
+        if ralint_frame is None:
+            return '(unknown)', 0
+        return ralint_frame.f_code.co_name, ralint_frame.f_lineno
+
+    def record(self, method, url, seconds):
+        """Record one request."""
+        entity = re.search(r'/webservice/[^/]+/([^/?]+)', url)
+        key = self.source() + (method,
+                               entity.group(1) if entity else url)
+        count, total = self.__stats.get(key, (0, 0.0))
+        self.__stats[key] = (count + 1, total + seconds)
+
+    def report(self):
+        """Return request sources, most requests first."""
+        ranked = sorted(self.__stats.items(),
+                        key=lambda item: (-item[1][0], -item[1][1]))
+        return ['{0}:{1} {2} {3}: {4} requests, {5:.2f}s'.format(
+            func, line, method, entity, count, total)
+            for (func, line, method, entity), (count, total) in ranked]
+
+
+class History(object):
+
+    """Local store of check findings for trend queries."""
+
+    GROUPS = {
+        'iteration': 'iteration',
+        'day':       "strftime('%Y-%m-%d', time, 'unixepoch')",
+        'run':       "strftime('%Y-%m-%d %H:%M:%S', time, 'unixepoch')"
+    }
+
+    def __init__(self, path):
+        """History constructor."""
+        super(History, self).__init__()
+        self.__db = sqlite3.connect(path)
+        self.__db.create_function(
+            'regexp', 2,
+            lambda pattern, value: re.search(pattern, value) is not None)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS findings (
+                check_name TEXT,
+                title      TEXT,
+                artifact   TEXT,
+                detail     TEXT,
+                project    TEXT,
+                iteration  TEXT,
+                time       REAL);
+            CREATE INDEX IF NOT EXISTS findings_title_time
+                ON findings (title, time);
+            CREATE INDEX IF NOT EXISTS findings_iteration
+                ON findings (iteration);
+            """)
+
+    def record(self, check, details, project, iteration, timestamp):
+        """Store the findings of one check."""
+        rows = []
+        for detail in details:
+            artifact = re.match(r'^([A-Z]{1,2}\d+):', detail)
+            rows.append((check.name, check.title,
+                         artifact.group(1) if artifact else None,
+                         detail, project, iteration, timestamp))
+
+        with self.__db:
+            self.__db.executemany(
+                'INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def counts(self, patterns, since=0, group_by='iteration'):
+        """
+        Return {title: [(group, count), ...]} for checks matching patterns.
+
+        Findings are counted once per group, even when several runs
+        reported them or the artifact was renamed in between.
+        """
+        group = self.GROUPS[group_by]
+        cursor = self.__db.execute(
+            'SELECT title, {0}, COUNT(DISTINCT COALESCE(artifact, detail)) '
+            'FROM findings '
+            'WHERE time >= ? AND ({1}) '
+            'GROUP BY title, {0} ORDER BY title, MIN(time)'.format(
+                group, ' OR '.join(['title REGEXP ?'] * len(patterns))),
+            [since] + list(patterns))
+
+        counts = {}
+        for title, group_value, count in cursor:
+            counts.setdefault(title, []).append((group_value, count))
+        return counts
+
+
+class Memo(object):
+
+    """Disk cache of check findings, evicting least recently used first."""
+
+    def __init__(self, path, max_size):
+        """Memo constructor. max_size is in bytes of cached findings."""
+        super(Memo, self).__init__()
+        self.__max_size = max_size
+        self.__db = sqlite3.connect(path, timeout=30)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS memo (
+                key     TEXT PRIMARY KEY,
+                details TEXT,
+                size    INTEGER,
+                used    REAL);
+            CREATE INDEX IF NOT EXISTS memo_used ON memo (used);
+            """)
+
+    def get(self, key):
+        """Return the findings stored for key, or None."""
+        row = self.__db.execute('SELECT details FROM memo WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+
+        with self.__db:
+            self.__db.execute('UPDATE memo SET used = ? WHERE key = ?',
+                              (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, details):
+        """Store the findings for key, evicting old entries over max_size."""
+        data = json.dumps(details)
+        with self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)',
+                (key, data, len(data), time.time()))
+
+            total = self.__db.execute(
+                'SELECT SUM(size) FROM memo').fetchone()[0]
+            for old_key, size in self.__db.execute(
+                    'SELECT key, size FROM memo ORDER BY used').fetchall():
+                if total <= self.__max_size:
+                    break
+                self.__db.execute('DELETE FROM memo WHERE key = ?',
+                                  (old_key,))
+                total -= size
+
+
+# Options that change what a check finds
+_RESULT_OPTIONS = ['rally_server', 'rally_project', 'points_per_iteration',
+                   'filter_owner', 'filter_iteration', 'filter_feature']
+
+
+def fingerprint(rally, check):
+    """
+    Return a key that changes whenever the inputs of check change.
+
+    The inputs are the options that affect findings plus the ObjectID and
+    LastUpdateDate of every entity of the types the check touches.
+    """
+    inputs = [__version__,
+              check.name,
+              [(name, rally.options.get(name)) for name in _RESULT_OPTIONS],
+              [(entity, rally.versions(entity)) for entity in check.entities]]
+    return hashlib.sha1(json.dumps(inputs)).hexdigest()
+
+
+def output_header(title, count, truncated=False):
+    """Print the title and finding count of a check function."""
+    print('==={0} ({1}){2}'.format(title, count,
+                                   ' TRUNCATED' if truncated else ''))
+
+
+def output(title, details, truncated=False):
     """Format the output of a check function."""
-    print('==={0} ({1})'.format(title, len(details)))
+    output_header(title, len(details), truncated)
 
     if not details or len(details) == 0:
         return
@@ -602,6 +1297,104 @@ def parse_cmd_line(cmd_line):
         metavar='PATTERN',
         default=['.*'])
 
+    main_parser.add_argument(
+        '--cache_ttl',
+        help='Seconds to reuse cached connection info. 0 disables the cache.',
+        type=int,
+        metavar='SECONDS',
+        default=3600)
+
+    main_parser.add_argument(
+        '--timeout',
+        help='Stop running checks after SECONDS.',
+        type=float,
+        metavar='SECONDS',
+        default=argparse.SUPPRESS)
+
+    main_parser.add_argument(
+        '--check_timeout',
+        help='Cancel any single check after SECONDS.',
+        type=float,
+        metavar='SECONDS',
+        default=argparse.SUPPRESS)
+
+    main_parser.add_argument(
+        '--summary',
+        help='Only print the number of findings of each check.',
+        action='store_true')
+
+    main_parser.add_argument(
+        '--fix',
+        help='Show how findings of the selected checks would be fixed.',
+        action='store_true')
+
+    main_parser.add_argument(
+        '--apply',
+        help='With --fix, apply the fixes. Old values are logged to '
+             '~/.ralint.fixes.',
+        action='store_true')
+
+    main_parser.add_argument(
+        '--history_file',
+        help='Append findings to FILE for "ralint history". '
+             'Defaults to ~/.ralint.history',
+        metavar='FILE',
+        default=os.path.expanduser('~/.ralint.history'))
+
+    main_parser.add_argument(
+        '--workers',
+        help='Run shards of the checks in N processes.',
+        type=int,
+        metavar='N',
+        default=argparse.SUPPRESS)
+
+    main_parser.add_argument(
+        '--work_dir',
+        help='Queue shards in DIR, a directory shared with '
+             '"ralint worker --work_dir DIR" processes on other machines.',
+        metavar='DIR',
+        default=argparse.SUPPRESS)
+
+    main_parser.add_argument(
+        '--shard_timeout',
+        help='Queue a shard again if its worker has not finished it '
+             'after SECONDS.',
+        type=float,
+        metavar='SECONDS',
+        default=3600)
+
+    main_parser.add_argument(
+        '--shard_by',
+        help='Give each shard one project, or one project and one check.',
+        choices=['project', 'check'],
+        default='project')
+
+    main_parser.add_argument(
+        '--shard_projects',
+        help='Shard the run over PROJECT instead of --rally_project.',
+        nargs='+',
+        metavar='PROJECT',
+        default=argparse.SUPPRESS)
+
+    main_parser.add_argument(
+        '--memo_file',
+        help='Reuse findings of checks whose inputs have not changed since '
+             'they were stored in FILE. Defaults to ~/.ralint.memo',
+        metavar='FILE',
+        default=os.path.expanduser('~/.ralint.memo'))
+
+    main_parser.add_argument(
+        '--memo_size',
+        help='Maximum size of the findings kept in --memo_file, in KB.',
+        type=int,
+        metavar='KB',
+        default=10240)
+
+    main_parser.add_argument(
+        '--trace',
+        help='Report which code caused each request to rally.',
+        action='store_true')
+
     main_parser.add_argument(
         '--filter_owner',
         help='Only check items owned by USER_NAME.',
@@ -611,8 +1404,10 @@ def parse_cmd_line(cmd_line):
 
     main_parser.add_argument(
         '--filter_iteration',
-        help='Only check items scheduled for ITERATION. '
-             'Default is current iteration.',
+        help='Only check items scheduled for ITERATION. ITERATION is '
+             'current, future, an iteration name or a date range like '
+             '2016-01-01..2016-03-31. Names and date ranges give one '
+             'report per iteration. Default is current iteration.',
         nargs='+',
         metavar='ITERATION',
         default=['current'])
@@ -630,24 +1425,130 @@ def parse_cmd_line(cmd_line):
     cmd_args = main_parser.parse_args(cmd_line)
     default_args.update(vars(cmd_args))
 
+    if (('workers' in default_args or 'work_dir' in default_args) and
+            (default_args.get('fix') or default_args.get('trace'))):
+        main_parser.error('--fix and --trace can not be used with '
+                          '--workers or --work_dir')
+
     log().info('args:\n' +
                pprint.pformat(default_args, width=1))
 
     return default_args
 
 
+def _connect_cache_key(conf_args):
+    """Return the key identifying a server/user/project combination."""
+    return '{0}|{1}|{2}'.format(conf_args['rally_server'],
+                                conf_args['rally_user'],
+                                conf_args.get('rally_project', ''))
+
+
+def _load_connect_cache(conf_args, path=None):
+    """Return cached connection info or None if it is missing or stale."""
+    path = path or os.path.expanduser('~/.ralint.cache')
+    ttl = int(conf_args.get('cache_ttl', 0))
+    if ttl <= 0:
+        return None
+
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+
+    entry = cache.get(_connect_cache_key(conf_args))
+    if entry is None or time.time() - entry.get('time', 0) > ttl:
+        return None
+
+    log().info('connect cache hit: %s', entry)
+    return entry
+
+
+def _save_connect_cache(conf_args, rally, path=None):
+    """Remember the workspace and project resolved by rally."""
+    path = path or os.path.expanduser('~/.ralint.cache')
+    if int(conf_args.get('cache_ttl', 0)) <= 0:
+        return
+
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        cache = {}
+
+    workspace = rally.getWorkspace().Name
+    cache[_connect_cache_key(conf_args)] = {
+        'workspace': workspace,
+        'project':   rally.getProject().Name,
+        'schema':    rally.schemas.get(workspace),
+        'time':      time.time()}
+
+    try:
+        _write_json(path, cache)
+    except (IOError, OSError):
+        log().warn('Could not write connect cache %s', path)
+
+
+def _write_json(path, data):
+    """Write data to path atomically, so readers never see partial files."""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.rename(tmp_path, path)
+
+
+class SchemaCachingRally(pyral.Rally):
+
+    """
+    pyral Rally that can reuse workspace schemas downloaded earlier.
+
+    pyral downloads the schema of the workspace on every connect. Schemas
+    passed in, keyed by workspace name, are used instead, and the ones
+    downloaded are kept in self.schemas for the connect cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """SchemaCachingRally constructor."""
+        self.schemas = kwargs.pop('schemas', None) or {}
+        super(SchemaCachingRally, self).__init__(*args, **kwargs)
+
+    def getSchemaInfo(self, workspace, project=None):
+        """Return the schema of workspace, downloading it if needed."""
+        if workspace not in self.schemas:
+            self.schemas[workspace] = super(
+                SchemaCachingRally, self).getSchemaInfo(workspace, project)
+        return self.schemas[workspace]
+
+
 def _ralint_init():
     """Return an instance of Rally."""
-    conf_args = parse_cmd_line(sys.argv[1:])
+    return _connect(parse_cmd_line(sys.argv[1:]))
 
+
+def _connect(conf_args):
+    """Return an instance of Rally for conf_args."""
     log().info('Config: ' + pprint.pformat(conf_args, width=1))
 
+    # A warm cache lets pyral skip the enumeration of every workspace in
+    # the subscription and the download of the workspace schema. pyral still
+    # looks up the user, subscription, workspace and project on connect.
+    cached = _load_connect_cache(conf_args)
+    connect_args = {}
+    if cached is not None:
+        connect_args = {'server_ping': False,
+                        'isolated_workspace': True,
+                        'workspace': cached['workspace']}
+        if cached.get('schema') is not None:
+            connect_args['schemas'] = {cached['workspace']: cached['schema']}
+
     try:
-        rally = pyral.Rally(
+        rally = SchemaCachingRally(
             conf_args['rally_server'],
             conf_args['rally_user'],
             conf_args['rally_password'],
-            project=conf_args['rally_project'])
+            project=conf_args.get('rally_project',
+                                  cached and cached['project']),
+            **connect_args)
     except Exception as ex:
         print('\nCould not connect to rally')
         print(str(ex))
@@ -657,7 +1558,17 @@ def _ralint_init():
         print('\n\n')
         raise
 
-    return Ralint(rally, conf_args)
+    if cached is None:
+        _save_connect_cache(conf_args, rally)
+
+    tracer = None
+    if conf_args.get('trace'):
+        tracer = RequestTracer()
+        tracer.install(rally.session)
+
+    ralint_obj = Ralint(rally, conf_args, tracer)
+    ralint_obj.bound_requests(rally.session)
+    return ralint_obj
 
 
 def get_check_functions():
@@ -670,19 +1581,635 @@ def get_check_functions():
     return checks
 
 
+class CheckInfo(object):
+
+    """Check metadata. The check function is imported on first load."""
+
+    def __init__(self, name, title, entities=(), function=None):
+        """
+        CheckInfo constructor.
+
+        function is either the check function or a 'module:attr' string.
+        """
+        super(CheckInfo, self).__init__()
+        self.name = name
+        self.title = title
+        self.entities = tuple(entities)
+        self.__function = function
+
+    def load(self):
+        """Return the check function, importing it if necessary."""
+        if not callable(self.__function):
+            module_name, attr = self.__function.split(':')
+            log().info('loading check %s from %s', self.name, module_name)
+            self.__function = getattr(
+                __import__(module_name, fromlist=[attr]), attr)
+        return self.__function
+
+
+def get_checks():
+    """
+    Return CheckInfo for built in and plugin checks.
+
+    Plugins register an entry point in the 'ralint.checks' group that
+    resolves to a list of dicts with keys name, title, entities and
+    function, where function is a 'module:attr' string. Keep that list in
+    a small module of its own; check modules are only imported once a
+    check is selected.
+    """
+    checks = [CheckInfo(f.__name__, f.__doc__, getattr(f, 'entities', ()), f)
+              for f in get_check_functions()]
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return checks
+
+    for entry_point in pkg_resources.iter_entry_points('ralint.checks'):
+        try:
+            checks.extend(CheckInfo(**desc) for desc in entry_point.load())
+        except Exception:
+            log().exception('Could not load checks from %s', entry_point)
+
+    return checks
+
+
+class CheckTimeout(BaseException):
+
+    """
+    Raised when a check runs past its deadline.
+
+    This is a BaseException so the except Exception blocks in pyral and in
+    checks don't swallow it.
+    """
+
+
+def _raise_check_timeout(signum, frame):
+    """Signal handler that cancels the running check."""
+    raise CheckTimeout()
+
+
+def _run_check(check_func, rally, timeout=None):
+    """
+    Run a check, giving up after timeout seconds.
+
+    Returns the findings collected so far and whether the check timed out.
+    Checks that yield their findings keep whatever they found before the
+    deadline.
+
+    The deadline is set on rally, which refuses new requests and caps the
+    timeout of HTTP requests once it is near. It is also checked after
+    every finding. Where available, SIGALRM interrupts local work too.
+    Rally's previous deadline is restored afterwards.
+    """
+    details = []
+    if timeout is not None and timeout <= 0:
+        return details, True
+
+    deadline = None if timeout is None else time.time() + timeout
+    alarm = deadline is not None and hasattr(signal, 'setitimer')
+    if alarm:
+        handler = signal.signal(signal.SIGALRM, _raise_check_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    previous_deadline = rally.deadline
+    rally.deadline = deadline
+    try:
+        for detail in check_func(rally):
+            details.append(detail)
+            if deadline is not None and time.time() >= deadline:
+                raise CheckTimeout()
+    except CheckTimeout:
+        log().warn('%s timed out after %s seconds',
+                   check_func.__name__, timeout)
+        return details, True
+    except Exception:
+        # pyral reports requests cut short by the deadline as its own errors
+        if deadline is None or time.time() < deadline:
+            raise
+        log().warn('%s failed after its deadline of %s seconds',
+                   check_func.__name__, timeout, exc_info=True)
+        return details, True
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+        rally.deadline = previous_deadline
+
+    return details, False
+
+
+def _run_bounded(rally, func, *args):
+    """
+    Call func(*args) within the deadline set on rally.
+
+    Returns func's result and False, or None and True if the deadline cut
+    it short.
+    """
+    try:
+        return func(*args), False
+    except CheckTimeout:
+        pass
+    except Exception:
+        # pyral reports requests cut short by the deadline as its own errors
+        if rally.deadline is None or time.time() < rally.deadline:
+            raise
+    log().warn('%s was cut short by the run deadline', func.__name__)
+    return None, True
+
+
+def _check_budget(options, deadline):
+    """Return the seconds the next check may run, or None if unlimited."""
+    budgets = []
+    if 'check_timeout' in options:
+        budgets.append(float(options['check_timeout']))
+    if deadline is not None:
+        budgets.append(deadline - time.time())
+    return min(budgets) if budgets else None
+
+
+def _selected_checks(options):
+    """Return the checks whose titles match include_checks."""
+    check_func_res = [re.compile(c) for c in options['include_checks']]
+    return [check for check in get_checks()
+            if any(check_func_re.search(check.title)
+                   for check_func_re in check_func_res)]
+
+
+def _check_results(rally, checks, fix_list, iteration_names=False):
+    """
+    Run checks, yielding a result dict per check and iteration.
+
+    Results are plain data so they can be sent between processes. When
+    fixing, the fixes for the findings are appended to fix_list. The
+    names of the selected iterations, which history records, are only
+    looked up with iteration_names.
+
+    Work outside the checks themselves, like finding the iterations,
+    fingerprinting and fixing, is bounded by the run's timeout too.
+    """
+    deadline = None
+    if 'timeout' in rally.options:
+        deadline = time.time() + float(rally.options['timeout'])
+
+    memo = None
+    if rally.options.get('memo_file'):
+        memo = Memo(rally.options['memo_file'],
+                    int(rally.options.get('memo_size', 10240)) * 1024)
+
+    rally.deadline = deadline
+    try:
+        project, _ = _run_bounded(rally, rally.project_name)
+        views, timed_out = _run_bounded(rally, get_iteration_views, rally)
+        if timed_out:
+            views = [(None, rally)]
+
+        for iteration, view in views:
+            iteration_name = iteration
+            if iteration_name is None and iteration_names:
+                iteration_name, _ = _run_bounded(rally, _iteration_names,
+                                                 rally)
+            for check in checks:
+                check_func = check.load()
+                if rally.tracer is not None:
+                    rally.tracer.check_func = check_func
+
+                result = {'iteration': iteration,
+                          'iteration_name': iteration_name,
+                          'check': check.name,
+                          'project': project,
+                          'details': [],
+                          'truncated': False}
+
+                if (rally.options.get('summary') and
+                        hasattr(check_func, 'query')):
+                    count, result['truncated'] = _run_bounded(
+                        rally, _query_count, view, check_func)
+                    result['count'] = count or 0
+                    yield result
+                    continue
+
+                key = None
+                details = None
+                if (memo is not None and check.entities and
+                        not getattr(check_func, 'volatile', False)):
+                    key, _ = _run_bounded(rally, fingerprint, view, check)
+                    if key is not None:
+                        details = memo.get(key)
+
+                if details is None:
+                    details, result['truncated'] = _run_check(
+                        check_func, view,
+                        _check_budget(rally.options, deadline))
+                    if key is not None and not result['truncated']:
+                        memo.put(key, details)
+
+                result['details'] = details
+                result['count'] = len(details)
+                yield result
+
+                if rally.options.get('fix') and hasattr(check_func, 'fixer'):
+                    fixes, _ = _run_bounded(rally, check_func.fixer, view)
+                    fix_list.extend(fixes or [])
+    finally:
+        rally.deadline = None
+        if rally.tracer is not None:
+            rally.tracer.check_func = None
+
+
+def _query_count(rally, check_func):
+    """Count the findings of a server_query check without fetching them."""
+    return rally.count(check_func.entity_name, check_func.query(rally))
+
+
+def _open_history(options):
+    """Return the History to record findings in, or None."""
+    if options.get('history_file') and not options.get('summary'):
+        return History(options['history_file'])
+    return None
+
+
+def _iteration_names(rally):
+    """Return the names of the iterations filter_iteration selects."""
+    if not rally.options.get('filter_iteration'):
+        return None
+    return ', '.join(sorted(set(itr.Name for itr in rally.get('Iteration'))))
+
+
+def _record_result(history, options, check, result, run_time):
+    """Record the findings of one result in history."""
+    history.record(check, result['details'], result['project'] or '',
+                   result['iteration_name'] or
+                   ' '.join(options.get('filter_iteration', [])),
+                   run_time)
+
+
+def _report(options, checks, results, history=None):
+    """Print check results as they arrive, recording them in history."""
+    checks_by_name = dict((check.name, check) for check in checks)
+    run_time = time.time()
+
+    timed_out = []
+    last_iteration = None
+    for result in results:
+        check = checks_by_name[result['check']]
+        iteration = result['iteration']
+        if iteration is not None and iteration != last_iteration:
+            print('###{0}\n'.format(iteration))
+        last_iteration = iteration
+
+        if options.get('summary'):
+            output_header(check.title, result['count'], result['truncated'])
+        else:
+            output(check.title, result['details'], result['truncated'])
+
+        if history is not None:
+            _record_result(history, options, check, result, run_time)
+
+        if result['truncated']:
+            timed_out.append(check.title if iteration is None else
+                             '{0}: {1}'.format(iteration, check.title))
+
+    if timed_out:
+        output('Timed out checks', timed_out)
+
+
 def _run_checkers(rally):
     """Run rally lint checks."""
-    check_func_res = [re.compile(c) for c in rally.options['include_checks']]
-    for check_func in get_check_functions():
-        for check_func_re in check_func_res:
-            if check_func_re.search(check_func.__doc__):
-                output(check_func.__doc__, check_func(rally))
-                break
+    checks = _selected_checks(rally.options)
+    fix_list = []
+    history = _open_history(rally.options)
+
+    _report(rally.options, checks,
+            _check_results(rally, checks, fix_list, history is not None),
+            history)
+
+    if rally.options.get('fix'):
+        output('Fixes', [fix.diff() for fix in fix_list])
+        if rally.options.get('apply') and fix_list:
+            rally.update(fix_list)
+
+    if rally.tracer is not None:
+        output('Requests by source', rally.tracer.report())
+
+
+# Options that stay on the coordinator when shards are queued for workers
+_LOCAL_OPTIONS = ['rally_user', 'rally_password', 'conf_file',
+                  'history_file', 'memo_file', 'memo_size', 'work_dir',
+                  'workers']
+
+
+def _shards(options, checks):
+    """Split a run into (project, check names) shards."""
+    projects = options.get('shard_projects') or [options.get('rally_project')]
+    if options.get('shard_by') == 'check':
+        check_groups = [[check.name] for check in checks]
+    else:
+        check_groups = [[check.name for check in checks]]
+
+    return [(project, names)
+            for project in projects
+            for names in check_groups]
+
+
+def _run_shard(conf_args, shard, deadline=None, iteration_names=False):
+    """
+    Run one shard over its own connection and return its results.
+
+    A deadline (in time.time() seconds) shortens the shard's timeout to
+    the time left in the run. See _check_results for iteration_names.
+    """
+    project, check_names = shard
+    conf_args = dict(conf_args)
+    if project is not None:
+        conf_args['rally_project'] = project
+
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError('the run timed out before the shard started')
+        conf_args['timeout'] = min(float(conf_args.get('timeout', remaining)),
+                                   remaining)
+
+    checks = [check for check in get_checks() if check.name in check_names]
+    return list(_check_results(_connect(conf_args), checks, [],
+                               iteration_names))
+
+
+def _shard_outcome(conf_args, shard, deadline=None, iteration_names=False):
+    """Run a shard, returning {'results': ...} or {'error': ...}."""
+    try:
+        return {'results': _run_shard(conf_args, shard, deadline,
+                                      iteration_names)}
+    except Exception as ex:
+        log().exception('Shard %s failed', shard)
+        return {'error': '{0}: {1}'.format(shard[0], ex)}
+
+
+def _shard_outcome_args(args):
+    """Call _shard_outcome with a tuple of arguments (for Pool.map)."""
+    return _shard_outcome(*args)
+
+
+def _split_outcomes(outcomes):
+    """Split shard outcomes into a list of results and a list of errors."""
+    shard_results = []
+    errors = []
+    for outcome in outcomes:
+        if 'error' in outcome:
+            errors.append(outcome['error'])
+        else:
+            shard_results.append(outcome['results'])
+    return shard_results, errors
+
+
+def _merge_results(checks, shard_results):
+    """Merge the results of all shards, in iteration and check order."""
+    check_order = dict((check.name, i) for i, check in enumerate(checks))
+    iteration_order = {}
+
+    merged = {}
+    for results in shard_results:
+        for result in results:
+            iteration_order.setdefault(result['iteration'],
+                                       len(iteration_order))
+            key = (result['iteration'], result['check'])
+            if key not in merged:
+                merged[key] = dict(result, details=list(result['details']))
+            else:
+                merged[key]['details'].extend(result['details'])
+                merged[key]['count'] += result['count']
+                merged[key]['truncated'] |= result['truncated']
+
+    return sorted(merged.values(),
+                  key=lambda r: (iteration_order[r['iteration']],
+                                 check_order[r['check']]))
+
+
+def _work_queue(work_dir, conf_args, wait=False, deadline=None, run='*'):
+    """
+    Run shards queued in work_dir until there are none left.
+
+    A shard is claimed by renaming it from todo/ to claimed/, which only
+    one worker can do, and its results are written to done/. The claim's
+    modification time records when it was claimed. With wait, keep
+    polling for new shards instead of returning. No shard is started
+    after deadline. run limits the queue to the run directories it
+    matches.
+    """
+    while True:
+        todo = sorted(glob.glob(
+            os.path.join(work_dir, run, 'todo', '*.json')))
+        if not todo and not wait:
+            return
+
+        for path in todo:
+            if deadline is not None and time.time() >= deadline:
+                return
+
+            run_dir = os.path.dirname(os.path.dirname(path))
+            name = os.path.basename(path)
+            claimed = os.path.join(run_dir, 'claimed', name)
+            try:
+                os.rename(path, claimed)
+                os.utime(claimed, None)
+            except OSError:
+                continue
+
+            try:
+                with open(claimed) as shard_file:
+                    shard = json.load(shard_file)
+            except IOError:
+                # the coordinator gave up and removed its run meanwhile
+                continue
+
+            options = dict(conf_args)
+            options.update(shard['options'])
+            outcome = _shard_outcome(options,
+                                     (shard['project'], shard['checks']),
+                                     deadline, shard['iteration_names'])
+            try:
+                _write_json(os.path.join(run_dir, 'done', name), outcome)
+            except (IOError, OSError):
+                log().warn('Run of shard %s was removed', claimed)
+
+        if not todo:
+            time.sleep(1)
+
+
+def _run_queued(conf_args, shards, deadline=None, iteration_names=False):
+    """
+    Queue shards in work_dir, help run them and wait for the results.
+
+    Only this run's shards are worked here; the run directory is removed
+    once the results are collected. Returns the results of each shard and
+    a list of errors.
+    """
+    run_dir = os.path.join(conf_args['work_dir'], '{0}-{1}'.format(
+        int(time.time()), os.getpid()))
+    for sub_dir in ['todo', 'claimed', 'done']:
+        os.makedirs(os.path.join(run_dir, sub_dir))
+
+    shared = dict((k, v) for k, v in conf_args.items()
+                  if k not in _LOCAL_OPTIONS)
+    names = []
+    for number, (project, check_names) in enumerate(shards):
+        names.append('{0:05d}.json'.format(number))
+        _write_json(os.path.join(run_dir, 'todo', names[-1]),
+                    {'options': shared,
+                     'project': project,
+                     'checks': check_names,
+                     'iteration_names': iteration_names})
+
+    # Shards claimed by a worker that died are queued again after
+    # shard_timeout, and the coordinator keeps working the queue, so the
+    # wait ends even without --timeout.
+    done_dir = os.path.join(run_dir, 'done')
+    shard_timeout = float(conf_args.get('shard_timeout', 3600))
+    while True:
+        _work_queue(conf_args['work_dir'], conf_args, deadline=deadline,
+                    run=os.path.basename(run_dir))
+        if (len(glob.glob(os.path.join(done_dir, '*.json'))) == len(names) or
+                (deadline is not None and time.time() >= deadline)):
+            break
+        time.sleep(1)
+        _requeue_stale(run_dir, names, shard_timeout)
+
+    outcomes = []
+    for name in names:
+        try:
+            with open(os.path.join(done_dir, name)) as done_file:
+                outcomes.append(json.load(done_file))
+        except IOError:
+            outcomes.append({'error': 'shard {0} did not finish'.format(name)})
+
+    # unfinished shards go too, so no worker picks them up later
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+    return _split_outcomes(outcomes)
+
+
+def _requeue_stale(run_dir, names, max_age):
+    """Queue shards claimed over max_age seconds ago without results again."""
+    for name in names:
+        if os.path.exists(os.path.join(run_dir, 'done', name)):
+            continue
+
+        claimed = os.path.join(run_dir, 'claimed', name)
+        try:
+            if time.time() - os.path.getmtime(claimed) > max_age:
+                log().warn('Queuing stale shard %s again', claimed)
+                os.rename(claimed, os.path.join(run_dir, 'todo', name))
+        except OSError:
+            # not claimed yet, or claimed again meanwhile
+            continue
+
+
+def _run_sharded(conf_args):
+    """Run checks in shards and print the merged report."""
+    deadline = None
+    if 'timeout' in conf_args:
+        deadline = time.time() + float(conf_args['timeout'])
+
+    checks = _selected_checks(conf_args)
+    shards = _shards(conf_args, checks)
+    history = _open_history(conf_args)
+
+    if conf_args.get('work_dir'):
+        shard_results, errors = _run_queued(conf_args, shards, deadline,
+                                            history is not None)
+    else:
+        pool = multiprocessing.Pool(int(conf_args['workers']))
+        try:
+            shard_results, errors = _split_outcomes(pool.map(
+                _shard_outcome_args,
+                [(conf_args, shard, deadline, history is not None)
+                 for shard in shards]))
+        finally:
+            pool.close()
+            pool.join()
+
+    # shards are recorded one by one to keep the project of each finding
+    if history is not None:
+        checks_by_name = dict((check.name, check) for check in checks)
+        run_time = time.time()
+        for results in shard_results:
+            for result in results:
+                _record_result(history, conf_args,
+                               checks_by_name[result['check']],
+                               result, run_time)
+
+    _report(conf_args, checks, _merge_results(checks, shard_results))
+
+    if errors:
+        output('Failed shards', errors)
+
+
+def _run_worker(conf_args):
+    """Run shards from work_dir until interrupted."""
+    workers = [multiprocessing.Process(target=_work_queue,
+                                       args=(conf_args['work_dir'],
+                                             conf_args,
+                                             True))
+               for _ in range(int(conf_args.get('workers', 1)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _show_history(cmd_line):
+    """Print finding counts from the history file."""
+    parser = argparse.ArgumentParser(prog='ralint history')
+
+    parser.add_argument(
+        '--history_file',
+        help='History file. Defaults to ~/.ralint.history',
+        metavar='FILE',
+        default=os.path.expanduser('~/.ralint.history'))
+
+    parser.add_argument(
+        '--include_checks',
+        help='Only show checks that match PATTERN.',
+        nargs='+',
+        metavar='PATTERN',
+        default=['.*'])
+
+    parser.add_argument(
+        '--since',
+        help='Only count findings since DATE (YYYY-MM-DD).',
+        metavar='DATE',
+        type=lambda date: datetime.datetime.strptime(date, '%Y-%m-%d'),
+        default=datetime.datetime(1970, 1, 1))
+
+    parser.add_argument(
+        '--by',
+        help='Count findings per iteration, day or run.',
+        choices=sorted(History.GROUPS.keys()),
+        default='iteration')
+
+    args = parser.parse_args(cmd_line)
+    since = calendar.timegm(args.since.timetuple())
+
+    counts = History(args.history_file).counts(
+        args.include_checks, since, args.by)
+    for title in sorted(counts.keys()):
+        output(title, ['{0}: {1}'.format(group, count)
+                       for group, count in counts[title]])
 
 
 def ralint():
     """Lint your rally."""
-    _run_checkers(_ralint_init())
+    if sys.argv[1:2] == ['history']:
+        _show_history(sys.argv[2:])
+    elif sys.argv[1:2] == ['worker']:
+        _run_worker(parse_cmd_line(sys.argv[2:]))
+    else:
+        conf_args = parse_cmd_line(sys.argv[1:])
+        if 'workers' in conf_args or 'work_dir' in conf_args:
+            _run_sharded(conf_args)
+        else:
+            _run_checkers(_connect(conf_args))
 
 
 def log():
@@ -1,6 +1,12 @@
 """Ralint tests."""
 
 
+import os
+import json
+import glob
+import shutil
+import tempfile
+import time
 from unittest2 import TestCase
 import ralint
 
@@ -45,17 +51,15 @@ class PyralRallyRespMock(object):
 
     """Mock for pyral RallyRESTResponse."""
 
-    def __init__(self, errors=None):
+    def __init__(self, errors=None, entities=None):
         """Initialize PyralRallyMock."""
         self.errors = errors or []
+        self.entities = entities or []
+        self.resultCount = len(self.entities)
 
     def __iter__(self):
         """Implement iterable protocol."""
-        return self
-
-    def next(self):
-        """Implement iterable protocol."""
-        raise StopIteration
+        return iter(self.entities)
 
 
 class PyralRallyMock(object):
@@ -150,6 +154,853 @@ class TestRalint(TestCase):
             options)
 
         ralint_obj.get('Task', initial_query)
+
+
+class NameMock(object):
+
+    """Mock for pyral entities that only need a Name."""
+
+    def __init__(self, name):
+        """Initialize NameMock."""
+        self.Name = name
+
+
+class ConnectedRallyMock(object):
+
+    """Mock for a connected pyral Rally."""
+
+    schemas = {'Workspace 1': [{'ElementName': 'Task'}]}
+
+    def getWorkspace(self):
+        """Return the mocked workspace."""
+        return NameMock('Workspace 1')
+
+    def getProject(self):
+        """Return the mocked project."""
+        return NameMock('Project 1')
+
+
+class TestConnectCache(TestCase):
+
+    """Connect cache Tests."""
+
+    def setUp(self):
+        """Create a scratch cache file."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache')
+        self.options = {'rally_server': 'server',
+                        'rally_user': 'user',
+                        'cache_ttl': 60}
+
+    def tearDown(self):
+        """Remove the scratch cache file."""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cache_round_trip(self):
+        """Saved connection info is loaded back."""
+        ralint._save_connect_cache(self.options, ConnectedRallyMock(),
+                                   self.path)
+        cached = ralint._load_connect_cache(self.options, self.path)
+        self.assertEqual(cached['workspace'], 'Workspace 1')
+        self.assertEqual(cached['project'], 'Project 1')
+        self.assertEqual(cached['schema'], [{'ElementName': 'Task'}])
+
+    def test_cached_schema_is_not_downloaded(self):
+        """A schema passed to SchemaCachingRally is used as is."""
+        def download(rally, workspace, project=None):
+            """Fail like a schema download that shouldn't happen."""
+            self.fail('schema of {0} downloaded'.format(workspace))
+
+        rally = ralint.SchemaCachingRally.__new__(ralint.SchemaCachingRally)
+        rally.schemas = {'Workspace 1': ['cached']}
+        get_schema_info = ralint.pyral.Rally.getSchemaInfo
+        ralint.pyral.Rally.getSchemaInfo = download
+        try:
+            self.assertEqual(rally.getSchemaInfo('Workspace 1'), ['cached'])
+        finally:
+            ralint.pyral.Rally.getSchemaInfo = get_schema_info
+
+    def test_cache_is_keyed_by_project(self):
+        """Connection info is not shared between projects."""
+        ralint._save_connect_cache(self.options, ConnectedRallyMock(),
+                                   self.path)
+        self.options['rally_project'] = 'Project 2'
+        self.assertIsNone(ralint._load_connect_cache(self.options, self.path))
+
+    def test_cache_can_be_disabled(self):
+        """A cache_ttl of 0 disables the cache."""
+        ralint._save_connect_cache(self.options, ConnectedRallyMock(),
+                                   self.path)
+        self.options['cache_ttl'] = 0
+        self.assertIsNone(ralint._load_connect_cache(self.options, self.path))
+
+    def test_missing_cache(self):
+        """A missing cache file is a cache miss."""
+        self.assertIsNone(ralint._load_connect_cache(self.options, self.path))
+
+
+class TestRunCheck(TestCase):
+
+    """Check runner Tests."""
+
+    def setUp(self):
+        """Create a Ralint to run checks with."""
+        self.ralint_obj = ralint.Ralint(PyralRallyMock(), {})
+
+    def test_check_without_timeout(self):
+        """A check without a timeout returns all of its findings."""
+        details, truncated = ralint._run_check(lambda _: ['a', 'b'],
+                                               self.ralint_obj)
+        self.assertEqual(details, ['a', 'b'])
+        self.assertFalse(truncated)
+
+    def test_check_timeout_keeps_partial_findings(self):
+        """A check that times out keeps the findings it already yielded."""
+        def slow_check(_):
+            """Yield one finding, then hang."""
+            yield 'a'
+            time.sleep(5)
+            yield 'b'
+
+        details, truncated = ralint._run_check(slow_check, self.ralint_obj,
+                                               0.05)
+        self.assertEqual(details, ['a'])
+        self.assertTrue(truncated)
+
+    def test_timeout_is_not_swallowed(self):
+        """A timeout firing inside except Exception still stops a check."""
+        def swallowing_check(_):
+            """Hang in a block that swallows exceptions, like pyral does."""
+            yield 'a'
+            try:
+                time.sleep(5)
+            except Exception:
+                pass
+            yield 'b'
+
+        start = time.time()
+        details, truncated = ralint._run_check(swallowing_check,
+                                               self.ralint_obj, 0.05)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(details, ['a'])
+        self.assertTrue(truncated)
+
+    def test_requests_are_refused_after_deadline(self):
+        """A check that swallows the alarm is stopped by its next request."""
+        def stubborn_check(rally):
+            """Ignore every interruption, then ask rally for more."""
+            yield 'a'
+            try:
+                time.sleep(5)
+            except BaseException:
+                pass
+            for story in rally.get('HierarchicalRequirement'):
+                yield story
+
+        details, truncated = ralint._run_check(stubborn_check,
+                                               self.ralint_obj, 0.05)
+        self.assertEqual(details, ['a'])
+        self.assertTrue(truncated)
+        self.assertIsNone(self.ralint_obj.deadline)
+
+    def test_expired_budget_skips_check(self):
+        """A check is not run when its budget is already spent."""
+        details, truncated = ralint._run_check(lambda _: ['a'],
+                                               self.ralint_obj, 0)
+        self.assertEqual(details, [])
+        self.assertTrue(truncated)
+
+    def test_requests_are_bounded_by_deadline(self):
+        """HTTP request timeouts never exceed the time left."""
+        timeouts = []
+
+        class Session(object):
+
+            """Record request timeouts."""
+
+            def request(self, method, url, timeout=None):
+                """Record the timeout."""
+                timeouts.append(timeout)
+
+        session = Session()
+        self.ralint_obj.bound_requests(session)
+        session.request('GET', 'url', timeout=30)
+        self.ralint_obj.deadline = time.time() + 10
+        session.request('GET', 'url', timeout=30)
+        self.assertEqual(timeouts[0], 30)
+        self.assertLessEqual(timeouts[1], 10)
+
+        self.ralint_obj.deadline = time.time() - 1
+        self.assertRaises(ralint.CheckTimeout, session.request, 'GET', 'url')
+
+    def test_budget_is_bounded_by_run_deadline(self):
+        """The check budget never exceeds the time left in the run."""
+        budget = ralint._check_budget({'check_timeout': 100},
+                                      time.time() + 10)
+        self.assertLessEqual(budget, 10)
+        self.assertIsNone(ralint._check_budget({}, None))
+
+
+class TestChecks(TestCase):
+
+    """Check registry Tests."""
+
+    def test_builtin_checks_are_registered(self):
+        """Built in checks are listed with their title and entities."""
+        checks = dict((c.name, c) for c in ralint.get_checks())
+        blocked = checks['check_stories_blocked']
+        self.assertEqual(blocked.title, 'Blocked stories.')
+        self.assertEqual(blocked.entities, ('HierarchicalRequirement',))
+        self.assertIs(blocked.load(), ralint.check_stories_blocked)
+
+    def test_check_is_loaded_by_name(self):
+        """A check given as 'module:attr' is imported when loaded."""
+        check = ralint.CheckInfo('check_join', 'Joined.', ['Task'],
+                                 'os.path:join')
+        self.assertIs(check.load(), os.path.join)
+
+
+class EntityMock(object):
+
+    """Mock for pyral entities."""
+
+    def __init__(self, **attrs):
+        """Initialize EntityMock."""
+        self.__dict__.update(attrs)
+
+
+class EntityRallyMock(object):
+
+    """Mock for pyral Rally that returns entities by entity name."""
+
+    def __init__(self, entities):
+        """Initialize EntityRallyMock."""
+        self.entities = entities
+        self.queries = []
+        self.fetches = []
+
+    def get(self, entity_name, query=None, **kwargs):
+        """Get the mocked entities."""
+        self.queries.append((entity_name, query))
+        self.fetches.append((entity_name, kwargs.get('fetch')))
+        return PyralRallyRespMock(
+            entities=self.entities.get(entity_name, []))
+
+    def getProject(self):
+        """Return the mocked default project."""
+        return NameMock('Project 1')
+
+
+class TestEntityIndex(TestCase):
+
+    """EntityIndex Tests."""
+
+    def setUp(self):
+        """Index a few tasks."""
+        self.ike = EntityMock(UserName='Ike')
+        self.story = EntityMock(ObjectID=10)
+        self.tasks = [
+            EntityMock(ObjectID=1, Owner=self.ike, WorkProduct=self.story),
+            EntityMock(ObjectID=2, Owner=None, WorkProduct=self.story),
+            EntityMock(ObjectID=3, Owner=self.ike, WorkProduct=None)]
+        self.index = ralint.EntityIndex('Task', self.tasks)
+
+    def test_index_by_object_id(self):
+        """Entities are found by ObjectID."""
+        self.assertIn(2, self.index)
+        self.assertNotIn(4, self.index)
+        self.assertIs(self.index.get(3), self.tasks[2])
+
+    def test_index_by_reference(self):
+        """Entities are found by owner and work product."""
+        self.assertEqual(self.index.lookup('owner', 'Ike'),
+                         [self.tasks[0], self.tasks[2]])
+        self.assertEqual(self.index.lookup('work_product', 10),
+                         self.tasks[:2])
+        self.assertEqual(self.index.lookup('owner', 'Luke'), [])
+
+    def test_unknown_key(self):
+        """Indexing by an unknown key is an error."""
+        self.assertRaises(ValueError, self.index.lookup, 'color', 'red')
+
+    def test_index_is_fetched_once(self):
+        """Ralint.index only fetches each entity and query once."""
+        calls = []
+
+        def get_delegate(*args, **kwargs):
+            """Count the calls to PyralRallyMock.get."""
+            calls.append(args)
+
+        ralint_obj = ralint.Ralint(
+            PyralRallyMock(get_delegate=get_delegate), {})
+        ralint_obj.index('Task')
+        ralint_obj.index('Task')
+        ralint_obj.index('Task', ralint.RallyQuery('X > Y'))
+        self.assertEqual(len(calls), 2)
+
+
+class TestIterationFilter(TestCase):
+
+    """Iteration filter Tests."""
+
+    def query(self, iters, entity_name='HierarchicalRequirement'):
+        """Return the filter query for iters."""
+        return str(ralint.RalintFilter().apply(
+            entity_name, None, {'filter_iteration': iters}))
+
+    def test_named_iterations(self):
+        """Iterations can be selected by name."""
+        query = self.query(['Sprint 1', 'Sprint 2'])
+        self.assertIn('Iteration.Name = "Sprint 1"', query)
+        self.assertRegexpMatches(query, r'\) OR \(')
+
+    def test_date_range(self):
+        """Iterations can be selected by date range."""
+        query = self.query(['2016-01-01..2016-03-31'], 'Iteration')
+        self.assertIn('StartDate <= 2016-03-31', query)
+        self.assertIn('EndDate >= 2016-01-01', query)
+        self.assertNotIn('.StartDate', query)
+
+    def test_invalid_iterations(self):
+        """Bad dates and mixing current with names are errors."""
+        self.assertRaises(ValueError, self.query, ['2016-01-01..soon'])
+        self.assertRaises(ValueError, self.query, ['current', 'Sprint 1'])
+
+    def test_iterations_are_partitioned_locally(self):
+        """Each selected iteration gets a view of its own entities."""
+        sprint1 = EntityMock(ObjectID=1, Name='Sprint 1',
+                             StartDate='2016-01-01')
+        sprint2 = EntityMock(ObjectID=2, Name='Sprint 2',
+                             StartDate='2016-01-15')
+        sprint2b = EntityMock(ObjectID=3, Name='Sprint 2',
+                              StartDate='2016-01-15')
+        stories = [EntityMock(ObjectID=10, Iteration=sprint1),
+                   EntityMock(ObjectID=11, Iteration=sprint2),
+                   EntityMock(ObjectID=12, Iteration=sprint2b)]
+        pyral_mock = EntityRallyMock({
+            'Iteration': [sprint2, sprint1, sprint2b],
+            'HierarchicalRequirement': stories})
+        ralint_obj = ralint.Ralint(
+            pyral_mock, {'filter_iteration': ['Sprint 1', 'Sprint 2']})
+
+        views = ralint.get_iteration_views(ralint_obj)
+        self.assertEqual([name for name, _ in views],
+                         ['Sprint 1', 'Sprint 2'])
+        self.assertEqual(views[0][1].get('HierarchicalRequirement'),
+                         stories[:1])
+        self.assertEqual(views[1][1].get('HierarchicalRequirement'),
+                         stories[1:])
+        self.assertEqual(
+            len([q for q in pyral_mock.queries
+                 if q[0] == 'HierarchicalRequirement']), 1)
+
+    def test_iteration_versions_use_minimal_fetch(self):
+        """Iteration versions partition one minimal download."""
+        sprint1 = EntityMock(ObjectID=1, Name='Sprint 1',
+                             StartDate='2016-01-01')
+        sprint2 = EntityMock(ObjectID=2, Name='Sprint 2',
+                             StartDate='2016-01-15')
+        stories = [EntityMock(ObjectID=10, LastUpdateDate='a',
+                              Iteration=sprint1),
+                   EntityMock(ObjectID=11, LastUpdateDate='b',
+                              Iteration=sprint2)]
+        pyral_mock = EntityRallyMock({
+            'Iteration': [sprint1, sprint2],
+            'HierarchicalRequirement': stories})
+        ralint_obj = ralint.Ralint(
+            pyral_mock, {'filter_iteration': ['Sprint 1', 'Sprint 2']})
+
+        views = ralint.get_iteration_views(ralint_obj)
+        self.assertEqual(views[0][1].versions('HierarchicalRequirement'),
+                         [(10, 'a')])
+        self.assertEqual(views[1][1].versions('HierarchicalRequirement'),
+                         [(11, 'b')])
+        self.assertEqual(
+            [f for f in pyral_mock.fetches
+             if f[0] == 'HierarchicalRequirement'],
+            [('HierarchicalRequirement', 'ObjectID,LastUpdateDate,Iteration')])
+
+    def test_date_queries_share_one_download(self):
+        """Views of one run build the same date query."""
+        sprint1 = EntityMock(ObjectID=1, Name='Sprint 1',
+                             StartDate='2016-01-01')
+        sprint2 = EntityMock(ObjectID=2, Name='Sprint 2',
+                             StartDate='2016-01-15')
+        pyral_mock = EntityRallyMock({'Iteration': [sprint1, sprint2]})
+        ralint_obj = ralint.Ralint(
+            pyral_mock, {'filter_iteration': ['Sprint 1', 'Sprint 2']})
+
+        for _, view in ralint.get_iteration_views(ralint_obj):
+            ralint._run_check(ralint.check_tasks_with_no_update, view)
+        self.assertEqual(
+            len([q for q in pyral_mock.queries if q[0] == 'Task']), 1)
+
+    def test_current_iteration_is_not_partitioned(self):
+        """The current iteration is checked without a view."""
+        ralint_obj = ralint.Ralint(PyralRallyMock(),
+                                   {'filter_iteration': ['current']})
+        self.assertEqual(ralint.get_iteration_views(ralint_obj),
+                         [(None, ralint_obj)])
+
+
+class SessionMock(object):
+
+    """Mock for a requests Session."""
+
+    def request(self, method, url, *args, **kwargs):
+        """Pretend to send a request."""
+        return url
+
+
+class ProjectRequestMock(object):
+
+    """Mock for pyral Rally that requests its project through a session."""
+
+    def __init__(self, session):
+        """Initialize ProjectRequestMock."""
+        self.session = session
+
+    def getProject(self):
+        """Request the default project."""
+        self.session.request('GET',
+                             'https://rally/slm/webservice/v2.0/project')
+        return NameMock('Project 1')
+
+
+class TestRequestTracer(TestCase):
+
+    """RequestTracer Tests."""
+
+    def test_requests_are_attributed_to_check_line(self):
+        """Requests are counted by check function and line."""
+        session = SessionMock()
+        tracer = ralint.RequestTracer()
+        tracer.install(session)
+        ralint_obj = ralint.Ralint(ProjectRequestMock(session), {})
+        ralint_obj.bound_requests(session)
+
+        def check_lazy(_):
+            """Make a request per story."""
+            url = 'https://rally/slm/webservice/v2.0/user/{0}'
+            return [session.request('GET', url.format(oid))
+                    for oid in range(3)]
+
+        tracer.check_func = check_lazy
+        ralint._run_check(check_lazy, ralint.Ralint(PyralRallyMock(), {}))
+        tracer.check_func = None
+        ralint_obj.project_name()
+
+        report = tracer.report()
+        self.assertEqual(len(report), 2)
+        self.assertRegexpMatches(
+            report[0], r'^check_lazy:\d+ GET user: 3 requests')
+        self.assertRegexpMatches(
+            report[1], r'^project_name:\d+ GET project: 1 requests')
+
+
+class TestSummary(TestCase):
+
+    """Summary mode Tests."""
+
+    def test_count_asks_for_one_minimal_page(self):
+        """Ralint.count reads the total result count of a tiny page."""
+        def get_delegate(entity_name, query=None, **kwargs):
+            """Check the arguments passed to PyralRallyMock.get."""
+            self.assertEqual(kwargs['pagesize'], 1)
+            self.assertEqual(kwargs['fetch'], 'ObjectID')
+
+        resp = PyralRallyRespMock(entities=[EntityMock()])
+        resp.resultCount = 42
+        ralint_obj = ralint.Ralint(
+            PyralRallyMock(resp, get_delegate=get_delegate), {})
+        self.assertEqual(ralint_obj.count('HierarchicalRequirement'), 42)
+
+    def test_server_query_check(self):
+        """Server query checks expose their query and still run."""
+        check = ralint.check_stories_blocked
+        self.assertEqual(check.__name__, 'check_stories_blocked')
+        self.assertEqual(check.__doc__, 'Blocked stories.')
+        self.assertEqual(check.entity_name, 'HierarchicalRequirement')
+        self.assertEqual(str(check.query(None)), 'Blocked = true')
+
+        story = EntityMock(FormattedID='US1', Name='Blocked')
+        ralint_obj = ralint.Ralint(
+            EntityRallyMock({'HierarchicalRequirement': [story]}), {})
+        self.assertEqual(check(ralint_obj), ['US1: Blocked'])
+
+
+class BatchRallyMock(object):
+
+    """Mock for the parts of pyral Rally used to post batches."""
+
+    service_url = 'https://rally/slm/webservice/v2.0'
+
+    def __init__(self, failing_entry=None, status_code=200):
+        """Initialize BatchRallyMock."""
+        self.session = self
+        self.posts = []
+        self.failing_entry = failing_entry
+        self.status_code = status_code
+
+    def obtainSecurityToken(self):
+        """Return a fake security token."""
+        return 'token'
+
+    def post(self, url, data=None):
+        """Record a batch post."""
+        self.posts.append((url, data))
+        return self
+
+    def json(self):
+        """Return a batch result, failing failing_entry of the last post."""
+        entries = json.loads(self.posts[-1][1])['Batch']
+        results = [{'Errors': [], 'Object': {}} for _ in entries]
+        if self.failing_entry is not None:
+            results[self.failing_entry]['Errors'].append('Not authorized')
+        return {'BatchResult': {'Results': results, 'Errors': []}}
+
+
+class TestFix(TestCase):
+
+    """Fix Tests."""
+
+    def setUp(self):
+        """Create a disowned task and its story."""
+        self.ike = EntityMock(ref='user/1', UserName='Ike')
+        self.story = EntityMock(ref='hierarchicalrequirement/10',
+                                ObjectID=10, Owner=self.ike)
+        self.task = EntityMock(ref='task/20', ObjectID=20, FormattedID='TA20',
+                               Name='Task', Owner=None,
+                               WorkProduct=self.story)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the scratch rollback log."""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fix(self):
+        """A fix describes itself and its batch entry."""
+        fix = ralint.Fix('Task', self.task, 'Owner', self.ike)
+        self.assertEqual(fix.diff(), 'TA20: Task: Owner (none) -> Ike')
+        self.assertEqual(fix.batch_entry(), {'Entry': {
+            'Path': '/task/20',
+            'Method': 'post',
+            'Body': {'task': {'Owner': '/user/1'}}}})
+        self.assertIsNone(fix.log_entry()['old'])
+
+    def test_disowned_tasks_get_story_owner(self):
+        """Disowned tasks are given to the owner of their story."""
+        ralint_obj = ralint.Ralint(EntityRallyMock({
+            'Task': [self.task],
+            'HierarchicalRequirement': [self.story]}), {})
+        fix_list = ralint.check_tasks_with_no_owner.fixer(ralint_obj)
+        self.assertEqual([f.value for f in fix_list], [self.ike])
+
+    def test_update_is_chunked_and_logged(self):
+        """Fixes are posted in chunks after being logged."""
+        pyral_mock = BatchRallyMock()
+        log_path = os.path.join(self.tmp_dir, 'fixes')
+        fix_list = [ralint.Fix('Task', self.task, 'Owner', self.ike)] * 5
+
+        ralint.Ralint(pyral_mock, {}).update(fix_list, log_path, 2)
+
+        self.assertEqual(len(pyral_mock.posts), 3)
+        self.assertTrue(pyral_mock.posts[0][0].endswith('/batch?key=token'))
+        with open(log_path) as log_file:
+            self.assertEqual(len(log_file.readlines()), 5)
+
+    def test_update_reports_failed_entries(self):
+        """A failed entry in a batch fails the update and is named."""
+        other = EntityMock(ref='task/21', ObjectID=21, FormattedID='TA21',
+                           Name='Other', Owner=None)
+        fix_list = [ralint.Fix('Task', self.task, 'Owner', self.ike),
+                    ralint.Fix('Task', other, 'Owner', self.ike)]
+        log_path = os.path.join(self.tmp_dir, 'fixes')
+
+        ralint_obj = ralint.Ralint(BatchRallyMock(failing_entry=1), {})
+        with self.assertRaisesRegexp(RuntimeError, 'TA21: Not authorized'):
+            ralint_obj.update(fix_list, log_path)
+
+        ralint_obj = ralint.Ralint(BatchRallyMock(status_code=500), {})
+        self.assertRaises(RuntimeError, ralint_obj.update, fix_list, log_path)
+
+
+class TestHistory(TestCase):
+
+    """History Tests."""
+
+    def setUp(self):
+        """Create a scratch history file."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = ralint.History(os.path.join(self.tmp_dir, 'history'))
+        self.blocked = ralint.CheckInfo('check_stories_blocked',
+                                        'Blocked stories.')
+        self.disowned = ralint.CheckInfo('check_stories_with_no_owner',
+                                         'Disowned stories.')
+
+    def tearDown(self):
+        """Remove the scratch history file."""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_counts_per_iteration(self):
+        """Findings are counted once per iteration."""
+        self.history.record(self.blocked, ['US1: a', 'US2: b'],
+                            'Project', 'Sprint 1', 100)
+        self.history.record(self.blocked, ['US1: a'],
+                            'Project', 'Sprint 1', 200)
+        self.history.record(self.blocked, ['US3: c'],
+                            'Project', 'Sprint 2', 300)
+        self.history.record(self.disowned, ['US4: d'],
+                            'Project', 'Sprint 2', 300)
+
+        self.assertEqual(
+            self.history.counts(['Blocked']),
+            {'Blocked stories.': [('Sprint 1', 2), ('Sprint 2', 1)]})
+
+    def test_renamed_artifact_is_counted_once(self):
+        """An artifact renamed between runs is still one finding."""
+        self.history.record(self.blocked, ['US1: old name'],
+                            'Project', 'Sprint 1', 100)
+        self.history.record(self.blocked, ['US1: new name'],
+                            'Project', 'Sprint 1', 200)
+        self.assertEqual(self.history.counts(['Blocked']),
+                         {'Blocked stories.': [('Sprint 1', 1)]})
+
+    def test_results_name_iteration_and_project(self):
+        """Results of a current iteration run carry its actual names."""
+        sprint = EntityMock(ObjectID=1, Name='Sprint 7')
+        ralint_obj = ralint.Ralint(
+            EntityRallyMock({'Iteration': [sprint, sprint]}),
+            {'filter_iteration': ['current']})
+        check = ralint.CheckInfo('check_x', 'X.', (), lambda _: [])
+        result = list(ralint._check_results(ralint_obj, [check], [],
+                                            True))[0]
+        self.assertEqual(result['iteration_name'], 'Sprint 7')
+        self.assertEqual(result['project'], 'Project 1')
+
+    def test_iteration_names_only_for_history(self):
+        """Iterations are not looked up when nothing is recorded."""
+        pyral_mock = EntityRallyMock({})
+        ralint_obj = ralint.Ralint(pyral_mock,
+                                   {'filter_iteration': ['current']})
+        check = ralint.CheckInfo('check_x', 'X.', (), lambda _: [])
+        result = list(ralint._check_results(ralint_obj, [check], []))[0]
+        self.assertIsNone(result['iteration_name'])
+        self.assertEqual(pyral_mock.queries, [])
+
+    def test_counts_since(self):
+        """Findings before since are not counted."""
+        self.history.record(self.blocked, ['US1: a'], 'Project', 'S1', 100)
+        self.history.record(self.blocked, ['US2: b'], 'Project', 'S2', 300)
+        self.assertEqual(self.history.counts(['.*'], since=200),
+                         {'Blocked stories.': [('S2', 1)]})
+
+
+class TestShards(TestCase):
+
+    """Sharded run Tests."""
+
+    def setUp(self):
+        """Use two checks and a scratch work dir."""
+        self.checks = [ralint.CheckInfo('check_a', 'A.'),
+                       ralint.CheckInfo('check_b', 'B.')]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_shard = ralint._run_shard
+
+    def tearDown(self):
+        """Restore _run_shard and remove the work dir."""
+        ralint._run_shard = self.run_shard
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def result(check, details, iteration=None, project='P1'):
+        """Return a check result."""
+        return {'iteration': iteration, 'check': check, 'project': project,
+                'details': details, 'count': len(details),
+                'truncated': False}
+
+    def test_shards(self):
+        """Runs are split by project and optionally by check."""
+        options = {'shard_projects': ['P1', 'P2'], 'shard_by': 'project'}
+        self.assertEqual(ralint._shards(options, self.checks),
+                         [('P1', ['check_a', 'check_b']),
+                          ('P2', ['check_a', 'check_b'])])
+        options['shard_by'] = 'check'
+        self.assertEqual(len(ralint._shards(options, self.checks)), 4)
+
+    def test_merge_results(self):
+        """Shard results are merged in iteration and check order."""
+        merged = ralint._merge_results(self.checks, [
+            [self.result('check_b', ['b1'], 'S1'),
+             self.result('check_b', [], 'S2')],
+            [self.result('check_a', ['a1'], 'S1'),
+             self.result('check_b', ['b2'], 'S1')]])
+        self.assertEqual(
+            [(r['iteration'], r['check'], r['details']) for r in merged],
+            [('S1', 'check_a', ['a1']),
+             ('S1', 'check_b', ['b1', 'b2']),
+             ('S2', 'check_b', [])])
+        self.assertEqual(merged[1]['count'], 2)
+
+    def test_queued_shards(self):
+        """Queued shards are run and their results collected."""
+        shard_texts = []
+
+        def run_shard(options, shard, deadline=None, iteration_names=False):
+            """Pretend to run a shard."""
+            for path in glob.glob(
+                    os.path.join(self.tmp_dir, '*', 'claimed', '*')):
+                with open(path) as shard_file:
+                    shard_texts.append(shard_file.read())
+            if shard[0] == 'Broken':
+                raise RuntimeError('no such project')
+            return [self.result(name, [shard[0]], project=shard[0])
+                    for name in shard[1]]
+
+        ralint._run_shard = run_shard
+        options = {'work_dir': self.tmp_dir, 'rally_password': 'secret',
+                   'memo_file': '/home/coordinator/.ralint.memo'}
+        shard_results, errors = ralint._run_queued(
+            options, [('P1', ['check_a']), ('Broken', ['check_a'])])
+
+        self.assertEqual(shard_results,
+                         [[self.result('check_a', ['P1'])]])
+        self.assertEqual(errors, ['Broken: no such project'])
+        self.assertTrue(shard_texts)
+        for shard_text in shard_texts:
+            self.assertNotIn('secret', shard_text)
+            self.assertNotIn('coordinator', shard_text)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_other_runs_are_left_alone(self):
+        """A coordinator only runs its own shards."""
+        def run_shard(options, shard, deadline=None, iteration_names=False):
+            """Pretend to run a shard."""
+            return [self.result(name, [shard[0]], project=shard[0])
+                    for name in shard[1]]
+
+        other_todo = os.path.join(self.tmp_dir, 'other', 'todo')
+        os.makedirs(other_todo)
+        open(os.path.join(other_todo, '00000.json'), 'w').close()
+
+        ralint._run_shard = run_shard
+        shard_results, errors = ralint._run_queued(
+            {'work_dir': self.tmp_dir}, [('P1', ['check_a'])])
+
+        self.assertEqual(shard_results,
+                         [[self.result('check_a', ['P1'])]])
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.tmp_dir), ['other'])
+        self.assertEqual(os.listdir(other_todo), ['00000.json'])
+
+    def test_failed_shard_is_reported(self):
+        """A failing shard becomes an error instead of ending the run."""
+        def run_shard(options, shard, deadline=None, iteration_names=False):
+            """Fail like a missing project."""
+            raise RuntimeError('no such project')
+
+        ralint._run_shard = run_shard
+        self.assertEqual(ralint._split_outcomes([
+            ralint._shard_outcome({}, ('Broken', ['check_a'])),
+            {'results': []}]), ([[]], ['Broken: no such project']))
+
+    def test_stale_claims_are_queued_again(self):
+        """Shards claimed long ago without results are queued again."""
+        for sub_dir in ['todo', 'claimed', 'done']:
+            os.makedirs(os.path.join(self.tmp_dir, sub_dir))
+        for name in ['stale.json', 'fresh.json', 'done.json']:
+            path = os.path.join(self.tmp_dir, 'claimed', name)
+            open(path, 'w').close()
+            if name != 'fresh.json':
+                os.utime(path, (time.time() - 100, time.time() - 100))
+        open(os.path.join(self.tmp_dir, 'done', 'done.json'), 'w').close()
+
+        ralint._requeue_stale(
+            self.tmp_dir, ['stale.json', 'fresh.json', 'done.json'], 50)
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'todo')),
+                         ['stale.json'])
+
+    def test_shard_after_deadline_is_not_run(self):
+        """A shard is not started once the run deadline has passed."""
+        self.assertRaises(RuntimeError, ralint._run_shard, {},
+                          ('P1', ['check_a']), time.time() - 1)
+
+
+class TestMemo(TestCase):
+
+    """Memo Tests."""
+
+    def setUp(self):
+        """Create a scratch memo file."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'memo')
+        self.story = EntityMock(ObjectID=10, FormattedID='US10', Name='x',
+                                LastUpdateDate='2016-01-01')
+
+    def tearDown(self):
+        """Remove the scratch memo file."""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_least_recently_used_are_evicted(self):
+        """Entries over the size cap are evicted, oldest use first."""
+        memo = ralint.Memo(self.path, 20)
+        memo.put('a', ['12345'])
+        memo.put('b', ['12345'])
+        memo.get('a')
+        memo.put('c', ['12345'])
+        self.assertEqual(memo.get('a'), ['12345'])
+        self.assertIsNone(memo.get('b'))
+        self.assertEqual(memo.get('c'), ['12345'])
+
+    def test_fingerprint_is_bounded_by_timeout(self):
+        """No versions are fetched for the memo once the run timed out."""
+        pyral_mock = EntityRallyMock(
+            {'HierarchicalRequirement': [self.story]})
+        ralint_obj = ralint.Ralint(pyral_mock,
+                                   {'timeout': 0, 'memo_file': self.path})
+        check = ralint.CheckInfo('check_x', 'X.', ['HierarchicalRequirement'],
+                                 lambda _: [])
+        result = list(ralint._check_results(ralint_obj, [check], []))[0]
+        self.assertTrue(result['truncated'])
+        self.assertEqual(pyral_mock.queries, [])
+        self.assertIsNone(ralint_obj.deadline)
+
+    def test_fingerprint_follows_updates(self):
+        """The fingerprint changes when an entity or option changes."""
+        check = ralint.CheckInfo('check_x', 'X.', ['HierarchicalRequirement'])
+
+        def key(options):
+            """Fingerprint check with a fresh Ralint."""
+            return ralint.fingerprint(ralint.Ralint(EntityRallyMock(
+                {'HierarchicalRequirement': [self.story]}), options), check)
+
+        first = key({})
+        self.assertEqual(key({}), first)
+        self.assertNotEqual(key({'points_per_iteration': 5}), first)
+        self.story.LastUpdateDate = '2016-01-02'
+        self.assertNotEqual(key({}), first)
+
+    def test_memoized_check_is_skipped(self):
+        """A check with unchanged inputs is not run again."""
+        calls = []
+
+        def check_x(rally):
+            """X."""
+            calls.append(rally)
+            return ['finding']
+
+        check = ralint.CheckInfo('check_x', 'X.',
+                                 ['HierarchicalRequirement'], check_x)
+        for _ in range(2):
+            ralint_obj = ralint.Ralint(
+                EntityRallyMock({'HierarchicalRequirement': [self.story]}),
+                {'memo_file': self.path})
+            results = list(ralint._check_results(ralint_obj, [check], []))
+            self.assertEqual(results[0]['details'], ['finding'])
+
+        self.assertEqual(len(calls), 1)
+
+
 # test rally query is formatted correctly
 # test output functions?
 # test checkers?